@@ -1,17 +1,28 @@
 # edis_pw.py
 import os
 import json
+import asyncio
+import hashlib
+import tempfile
+import time
 from contextlib import suppress
-from typing import List, Dict, Any, Optional
+from urllib.parse import urlparse
+from collections import OrderedDict, deque
+from typing import Deque, List, Dict, Any, Optional
 
 from playwright.async_api import async_playwright, TimeoutError as PwTimeoutError
 
 VERSION = "v0.8-dom-tries"
 
+# log diagnostici verbosi (payload, elenco frame) solo con EDIS_DEBUG=1
+DEBUG = os.getenv("EDIS_DEBUG") == "1"
+LOG_MAX_LINES = 200
+
 CURVE_URL = "https://private.e-distribuzione.it/PortaleClienti/s/curvedicarico"
+PORTAL_HOST = urlparse(CURVE_URL).hostname or ""
 
 # possibile pulsante di download CSV (tante varianti)
-CSV_SELECTORS = [
+CSV_SELECTORS = (
     "button:has-text('Scarica il dettaglio dei quarti orari')",
     "a:has-text('Scarica il dettaglio dei quarti orari')",
     "button:has-text('Scarica CSV')",
@@ -20,26 +31,426 @@ CSV_SELECTORS = [
     "a:has-text('Download CSV')",
     "[data-testid='download-csv']",
     "#downloadCsv",
-    ".slds-button.slds-button_brand.slds-float_right",
-]
+)
+# pulsante brand generico di Lightning: solo se nessun candidato specifico è visibile
+CSV_GENERIC_SELECTOR = ".slds-button.slds-button_brand.slds-float_right"
+CSV_SELECTOR = ",".join(CSV_SELECTORS + (CSV_GENERIC_SELECTOR,))
+# per il click contano solo i pulsanti visibili (su Lightning ce ne sono di nascosti)
+CSV_VISIBLE_SELECTOR = ",".join(f"{s}:visible" for s in CSV_SELECTORS)
+CSV_GENERIC_VISIBLE_SELECTOR = f"{CSV_GENERIC_SELECTOR}:visible"
+CSV_ANY_VISIBLE_SELECTOR = f"{CSV_VISIBLE_SELECTOR},{CSV_GENERIC_VISIBLE_SELECTOR}"
 
 # login (Salesforce classico)
-LOGIN_USER_SELS = ["#username", "input[name='username']", "input#user_email"]
-LOGIN_PASS_SELS = ["#password", "input[name='password']", "input#user_password"]
-LOGIN_SUBMIT_SELS = ["#Login", "input#Login", "button[type='submit']", "button:has-text('Accedi')", "input[value='Log In']"]
+LOGIN_USER_SELS = ("#username", "input[name='username']", "input#user_email")
+LOGIN_PASS_SELS = ("#password", "input[name='password']", "input#user_password")
+LOGIN_SUBMIT_SELS = ("#Login", "input#Login", "button[type='submit']", "button:has-text('Accedi')", "input[value='Log In']")
+LOGIN_USER_SELECTOR = ",".join(LOGIN_USER_SELS)
+LOGIN_PASS_SELECTOR = ",".join(LOGIN_PASS_SELS)
+LOGIN_SUBMIT_SELECTOR = ",".join(LOGIN_SUBMIT_SELS)
+
+# elementi che indicano che la pagina è pronta: pulsante CSV oppure form di login
+READY_SELECTOR = f"{CSV_SELECTOR},{LOGIN_PASS_SELECTOR}"
+
+# risorse inutili per compilare il form e scaricare il CSV: bloccate da Chromium
+# stesso (Network.setBlockedURLs), senza intercettare le richieste via route
+BLOCKED_ASSET_EXTS = ("png", "jpg", "jpeg", "gif", "webp", "svg", "ico", "woff", "woff2", "ttf", "otf", "eot", "mp4", "webm", "mp3")
+BLOCKED_DOMAINS = (
+    "google-analytics.com",
+    "googletagmanager.com",
+    "doubleclick.net",
+    "hotjar.com",
+    "segment.io",
+    "segment.com",
+    "salesforceliveagent.com",
+)
+BLOCKED_URL_PATTERNS = [f"*.{ext}" for ext in BLOCKED_ASSET_EXTS] + [f"*{d}*" for d in BLOCKED_DOMAINS]
+# PW_BLOCK_ASSETS=0 per caricare tutto (utile quando si fa debug del portale)
+PW_BLOCK_ASSETS = os.getenv("PW_BLOCK_ASSETS", "1") != "0"
+
+CONTEXT_ARGS_BASE: Dict[str, Any] = {
+    "accept_downloads": True,
+    "java_script_enabled": True,
+    # User-Agent reale di Chrome stabile
+    "user_agent": (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+        "AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/124.0.0.0 Safari/537.36"
+    ),
+}
+
+LAUNCH_ARGS = [
+    "--no-sandbox",
+    "--disable-dev-shm-usage",
+    "--disable-features=site-per-process",
+    # avvio più leggero: niente GPU, estensioni, sync, audio, first-run
+    "--disable-gpu",
+    "--disable-extensions",
+    "--disable-default-apps",
+    "--disable-sync",
+    "--mute-audio",
+    "--disable-translate",
+    "--no-first-run",
+    "--no-default-browser-check",
+    # i timer in background non devono rallentare le pagine headless
+    "--disable-background-timer-throttling",
+    "--disable-renderer-backgrounding",
+    "--disable-backgrounding-occluded-windows",
+    "--disable-blink-features=AutomationControlled",
+]
+
+# Playwright + Chromium condivisi da tutto il processo: il lancio del browser
+# è la parte più lenta, per ogni richiesta apriamo solo una nuova pagina.
+_PW = None
+_BROWSER = None
+_BROWSER_LOCK = asyncio.Lock()
+
+# se impostato, ci colleghiamo a un Chromium già avviato (condiviso tra più worker)
+PW_CDP_ENDPOINT = os.getenv("PW_CDP_ENDPOINT")
+
+# un context autenticato condiviso per identità (storage_state, mtime, username,
+# digest password): ogni job apre solo una nuova pagina al suo interno
+CTX_IDLE_TTL_S = int(os.getenv("EDIS_CTX_IDLE_TTL", "600"))
+_CONTEXTS: Dict[tuple, tuple] = {}
+# un lock per identità (la chiave senza mtime): lo storage_state riscritto non ne crea di nuovi
+_CONTEXT_LOCKS: Dict[tuple, asyncio.Lock] = {}
+# job in corso per context: un context scartato si chiude solo quando nessuno lo usa più
+_CONTEXT_REFS: Dict[Any, int] = {}
+
+# chiave casuale per processo: il digest della password resta solo in memoria
+# e non è confrontabile fuori da qui
+_CRED_KEY = os.urandom(16)
+
+# massimo numero di job contemporanei di default in refresh_many
+PW_MAX_CONTEXTS = int(os.getenv("PW_MAX_CONTEXTS", "4"))
+
+# URL HTTP dell'ultimo download CSV riuscito per (identità, pod, periodo):
+# le volte successive lo richiediamo direttamente con i cookie del context.
+# LRU limitato a PW_DOWNLOAD_URLS_MAX voci: il servizio gira a lungo
+PW_DOWNLOAD_URLS_MAX = int(os.getenv("PW_DOWNLOAD_URLS_MAX", "256"))
+_DOWNLOAD_URLS: "OrderedDict[tuple, str]" = OrderedDict()
+
+# pagina già su curvedicarico lasciata aperta dopo un download riuscito,
+# per identità (storage_state, username, digest password): il job successivo clicca e basta
+PW_PAGE_TTL_S = int(os.getenv("PW_PAGE_TTL_S", "300"))
+_WARM_PAGES: Dict[tuple, tuple] = {}
+# sulla pagina parcheggiata il pulsante c'è già: se non compare subito la pagina
+# non è più buona e conviene ripartire da una nuova
+WARM_BUTTON_TIMEOUT_MS = 2_000
+WARM_CSV_TIMEOUT_MS = 15_000
+
+# path del frame "curvedicarico" scelto l'ultima volta (il layout del portale è stabile)
+_FRAME_URL_HINT: Optional[str] = None
+
+
+async def _get_browser():
+    global _PW, _BROWSER
+    async with _BROWSER_LOCK:
+        if _BROWSER is not None and not _BROWSER.is_connected():
+            # Chromium crashato/chiuso: i context condivisi sono morti con lui
+            _BROWSER = None
+            _CONTEXTS.clear()
+            _CONTEXT_REFS.clear()
+            _WARM_PAGES.clear()
+        if _BROWSER is None:
+            if _PW is None:
+                _PW = await async_playwright().start()
+            if PW_CDP_ENDPOINT:
+                _BROWSER = await _PW.chromium.connect_over_cdp(PW_CDP_ENDPOINT)
+            else:
+                _BROWSER = await _PW.chromium.launch(headless=True, args=LAUNCH_ARGS)
+        return _BROWSER
+
+
+async def _block_assets(page) -> None:
+    if not PW_BLOCK_ASSETS:
+        return
+    cdp = await page.context.new_cdp_session(page)
+    await cdp.send("Network.enable")
+    await cdp.send("Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS})
+
+
+async def _new_context(browser, storage_path: Optional[str]):
+    context_args = dict(CONTEXT_ARGS_BASE)
+    if storage_path:
+        # dict già parsato: Playwright non rilegge il file a ogni context
+        context_args["storage_state"] = _load_storage_state(storage_path)
+    context = await browser.new_context(**context_args)
+    context.set_default_timeout(60_000)
+    context.set_default_navigation_timeout(60_000)
+    return context
+
+
+def _cred_digest(password: Optional[str]) -> Optional[bytes]:
+    """Digest della password da mettere nelle chiavi: una password diversa non riusa la sessione altrui."""
+    if not password:
+        return None
+    return hashlib.blake2b(password.encode("utf-8"), key=_CRED_KEY, digest_size=16).digest()
+
+
+async def _get_context(browser, key: tuple, storage_path: Optional[str]):
+    """
+    Restituisce il context condiviso per `key`, creandolo se manca o è inattivo da
+    troppo, e lo segna in uso: il job deve poi chiamare _release_context.
+    """
+    async with _identity_lock(key):
+        now = time.monotonic()
+        await _sweep_idle_contexts(now)
+        entry = _CONTEXTS.get(key)
+        if entry is not None:
+            ctx, last_used = entry
+            if now - last_used < CTX_IDLE_TTL_S:
+                _CONTEXTS[key] = (ctx, now)
+                _CONTEXT_REFS[ctx] = _CONTEXT_REFS.get(ctx, 0) + 1
+                return ctx
+            del _CONTEXTS[key]
+            await _close_if_unused(ctx)
+        # storage_state rigenerato: i context della stessa identità con il file vecchio non servono più
+        for old_key in [k for k in _CONTEXTS if k != key and k[0] == key[0] and k[2:] == key[2:]]:
+            old_ctx, _ = _CONTEXTS.pop(old_key)
+            await _close_if_unused(old_ctx)
+        ctx = await _new_context(browser, storage_path)
+        _CONTEXTS[key] = (ctx, now)
+        _CONTEXT_REFS[ctx] = 1
+        return ctx
+
+
+def _identity(key: tuple) -> tuple:
+    # chiave del context senza mtime dello storage_state
+    return (key[0],) + key[2:]
+
+
+def _identity_lock(key: tuple) -> asyncio.Lock:
+    return _CONTEXT_LOCKS.setdefault(_identity(key), asyncio.Lock())
+
+
+async def _close_if_unused(ctx) -> None:
+    """Chiude un context già tolto da _CONTEXTS, se nessun job lo sta usando (altrimenti lo chiude l'ultimo)."""
+    if _CONTEXT_REFS.get(ctx, 0) > 0:
+        return
+    _CONTEXT_REFS.pop(ctx, None)
+    with suppress(Exception):
+        await ctx.close()
+
+
+async def _sweep_idle_contexts(now: float) -> None:
+    # identità che non tornano più: i loro context non devono restare aperti per sempre.
+    # Più sweep (di identità diverse) possono girare insieme e ogni close() è un
+    # await: tolgo la voce con pop e la chiudo solo se è ancora quella vista qui
+    for k, entry in list(_CONTEXTS.items()):
+        ctx, last_used = entry
+        if now - last_used < CTX_IDLE_TTL_S or _CONTEXT_REFS.get(ctx, 0) > 0:
+            continue
+        current = _CONTEXTS.pop(k, None)
+        if current is None:
+            continue
+        if current is not entry:
+            # rinnovata o sostituita nel frattempo: la rimetto
+            _CONTEXTS[k] = current
+            continue
+        await _close_if_unused(ctx)
+    # pagine parcheggiate e mai riprese
+    for k, entry in list(_WARM_PAGES.items()):
+        page, parked_at = entry
+        if now - parked_at < PW_PAGE_TTL_S and not page.is_closed():
+            continue
+        # come sopra: un altro sweep o _take_warm_page può averla già presa
+        current = _WARM_PAGES.pop(k, None)
+        if current is None:
+            continue
+        if current is not entry:
+            _WARM_PAGES[k] = current
+            continue
+        with suppress(Exception):
+            await page.close()
+    # lock di identità senza più context (es. password sbagliate): non servono più
+    live = {_identity(k) for k in _CONTEXTS}
+    for ident in [i for i, lk in _CONTEXT_LOCKS.items() if i not in live and not lk.locked()]:
+        _CONTEXT_LOCKS.pop(ident, None)
+
+
+async def _release_context(ctx) -> None:
+    """Il job ha finito con `ctx`: se era già stato scartato e nessun altro lo usa, lo chiude."""
+    n = _CONTEXT_REFS.get(ctx, 0) - 1
+    if n > 0:
+        _CONTEXT_REFS[ctx] = n
+        return
+    _CONTEXT_REFS.pop(ctx, None)
+    if not any(c is ctx for c, _ in _CONTEXTS.values()):
+        with suppress(Exception):
+            await ctx.close()
+
+
+async def _take_warm_page(key: tuple, context):
+    """Prende (in esclusiva) la pagina parcheggiata per `key`, se ancora utilizzabile."""
+    entry = _WARM_PAGES.pop(key, None)
+    if entry is None:
+        return None
+    page, parked_at = entry
+    usable = (
+        page.context is context
+        and not page.is_closed()
+        and time.monotonic() - parked_at < PW_PAGE_TTL_S
+        and "curvedicarico" in (page.url or "").lower()
+    )
+    if usable:
+        return page
+    with suppress(Exception):
+        await page.close()
+    return None
+
+
+async def _park_page(key: tuple, page) -> None:
+    """Lascia aperta la pagina per il prossimo job (se non ce n'è già una)."""
+    if key in _WARM_PAGES or "curvedicarico" not in (page.url or "").lower():
+        with suppress(Exception):
+            await page.close()
+        return
+    _WARM_PAGES[key] = (page, time.monotonic())
+
+
+def _drop_context(context) -> None:
+    """
+    Scarta il context condiviso (es. sessione scaduta): il prossimo job ne crea uno
+    nuovo. Non lo chiude: gli altri job in corso lo stanno ancora usando, lo chiude
+    _release_context dell'ultimo.
+    """
+    for k in [k for k, (c, _) in _CONTEXTS.items() if c is context]:
+        del _CONTEXTS[k]
+
+
+async def start_browser() -> None:
+    """Avvia subito il browser condiviso (da chiamare allo startup): la prima richiesta non paga il lancio."""
+    await _get_browser()
+
+
+async def close_browser() -> None:
+    """Chiude browser e Playwright condivisi (da chiamare allo shutdown)."""
+    global _PW, _BROWSER
+    async with _BROWSER_LOCK:
+        for ctx, _ in _CONTEXTS.values():
+            with suppress(Exception):
+                await ctx.close()
+        _CONTEXTS.clear()
+        _CONTEXT_REFS.clear()
+        _WARM_PAGES.clear()
+        if _BROWSER is not None:
+            with suppress(Exception):
+                await _BROWSER.close()
+            _BROWSER = None
+        if _PW is not None:
+            with suppress(Exception):
+                await _PW.stop()
+            _PW = None
+
+
+# mtime dello storage_state (None se manca) ricontrollato al più ogni STORAGE_CHECK_TTL_S secondi
+STORAGE_CHECK_TTL_S = int(os.getenv("EDIS_STORAGE_CHECK_TTL", "60"))
+_STORAGE_PATH_CHECKS: Dict[str, tuple] = {}
+
+
+def _storage_state_mtime(p: str) -> Optional[float]:
+    now = time.monotonic()
+    checked = _STORAGE_PATH_CHECKS.get(p)
+    if checked is None or now - checked[0] > STORAGE_CHECK_TTL_S:
+        try:
+            mtime: Optional[float] = os.path.getmtime(p)
+        except OSError:
+            mtime = None
+        checked = (now, mtime)
+        _STORAGE_PATH_CHECKS[p] = checked
+    return checked[1]
 
 
 def _storage_state_path() -> Optional[str]:
     p = os.getenv("STORAGE_STATE") or "/app/storage_state.json"
-    return p if os.path.exists(p) else None
+    return p if _storage_state_mtime(p) is not None else None
+
+
+# storage_state già letti da disco: path -> (mtime, dict, digest)
+_STORAGE_STATES: Dict[str, tuple] = {}
+
+
+def _state_digest(state: Dict[str, Any]) -> bytes:
+    return hashlib.blake2b(json.dumps(state, sort_keys=True).encode("utf-8"), digest_size=16).digest()
+
+
+def _load_storage_state(path: str) -> Dict[str, Any]:
+    mtime = os.path.getmtime(path)
+    cached = _STORAGE_STATES.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, encoding="utf-8") as f:
+        state = json.load(f)
+    _STORAGE_STATES[path] = (mtime, state, _state_digest(state))
+    return state
+
+
+async def _persist_storage_state(context, path: str, key: tuple, log: Deque[str]) -> None:
+    """
+    Riscrive lo storage_state con i cookie aggiornati dal context (sessione più
+    fresca per le richieste e i riavvii successivi). Scrive solo se è cambiato,
+    in modo atomico (file temporaneo + os.replace).
+    """
+    state = await context.storage_state()
+    digest = _state_digest(state)
+    cached = _STORAGE_STATES.get(path)
+    if cached and cached[2] == digest:
+        return
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".storage_state.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, path)
+    except Exception:
+        with suppress(OSError):
+            os.unlink(tmp)
+        raise
+    mtime = os.path.getmtime(path)
+    _STORAGE_STATES[path] = (mtime, state, digest)
+    _STORAGE_PATH_CHECKS[path] = (time.monotonic(), mtime)
+    # il file l'abbiamo scritto noi: il context attuale resta quello buono. Lo
+    # cerco per oggetto e non per `key`: un altro job può averlo già spostato
+    # sulla mtime della sua scrittura
+    new_key = (key[0], mtime) + key[2:]
+    async with _identity_lock(key):
+        for k in [k for k, (c, _) in _CONTEXTS.items() if c is context and k != new_key]:
+            _CONTEXTS[new_key] = _CONTEXTS.pop(k)
+    log.append("storage_state aggiornato.")
+
+
+def _cookie_for_portal(cookie: Dict[str, Any]) -> bool:
+    domain = (cookie.get("domain") or "").lstrip(".").lower()
+    return bool(domain) and (PORTAL_HOST == domain or PORTAL_HOST.endswith("." + domain))
+
+
+def _session_expired(storage_path: str) -> bool:
+    """
+    True se il cookie di sessione nello storage_state è scaduto o scade entro un
+    minuto. Guardo il file (già parsato in cache) e non context.cookies(): Chromium
+    scarta i cookie già scaduti quando crea il context, e lì sembrerebbero assenti.
+    """
+    # solo i cookie inviati al portale: quelli di terze parti (es. _hjSession_* di
+    # Hotjar) hanno scadenze loro e non dicono niente sulla sessione
+    cookies = [c for c in _load_storage_state(storage_path).get("cookies") or [] if _cookie_for_portal(c)]
+    sess = next((c for c in cookies if c.get("name", "").lower() == "sid"), None)
+    if sess is None:
+        sess = next((c for c in cookies if "session" in c.get("name", "").lower()), None)
+    if sess is None:
+        # nessun cookie riconoscibile: decide la navigazione
+        return False
+    expires = sess.get("expires", -1)
+    return 0 < expires < time.time() + 60
 
 
 async def _is_login_page(page) -> bool:
     url = (page.url or "").lower()
     if "/login" in url:
         return True
+    if "curvedicarico" in url:
+        # siamo già sulla pagina di destinazione: niente query sul DOM
+        return False
     with suppress(Exception):
-        if await page.locator(",".join(LOGIN_PASS_SELS)).count() > 0:
+        if await page.locator(LOGIN_PASS_SELECTOR).count() > 0:
             return True
     return False
 
@@ -59,34 +470,110 @@ def _score_frame(f) -> int:
     return s
 
 
-async def _pick_main_frame(page, log: List[str]):
+def _remember_download_url(key: tuple, url: str) -> None:
+    _DOWNLOAD_URLS[key] = url
+    _DOWNLOAD_URLS.move_to_end(key)
+    while len(_DOWNLOAD_URLS) > PW_DOWNLOAD_URLS_MAX:
+        _DOWNLOAD_URLS.popitem(last=False)
+
+
+async def _try_direct_download(context, url: str, log: Deque[str]) -> bool:
+    try:
+        resp = await context.request.get(url, timeout=30_000)
+    except Exception as e:
+        log.append(f"Download diretto fallito: {type(e).__name__}: {e}")
+        return False
+    ctype = (resp.headers.get("content-type") or "").lower()
+    ok = resp.ok and ("csv" in ctype or "octet-stream" in ctype)
+    log.append(f"Download diretto via HTTP: status={resp.status} content-type={ctype or '-'}")
+    with suppress(Exception):
+        await resp.dispose()
+    return ok
+
+
+def _pick_main_frame(page, log: Deque[str]):
+    global _FRAME_URL_HINT
     frames = page.frames
-    log.append(f"Frame totali: {len(frames)}")
-    ranked = sorted(frames, key=_score_frame, reverse=True)
-    for fr in ranked:
-        log.append(f"- Frame url='{fr.url}' title='{fr.name}' -> score={_score_frame(fr)}")
-    chosen = ranked[0] if ranked else page.main_frame
-    log.append(f"Frame scelto url='{chosen.url}' score={_score_frame(chosen)}")
+    if _FRAME_URL_HINT:
+        for fr in frames:
+            if _FRAME_URL_HINT in (fr.url or ""):
+                log.append(f"Frame scelto (hint) url='{fr.url}'")
+                return fr
+    # score calcolato una volta sola per frame
+    ranked = sorted(((_score_frame(fr), fr) for fr in frames), key=lambda t: t[0], reverse=True)
+    if DEBUG:
+        log.append(f"Frame totali: {len(frames)}")
+        for score, fr in ranked:
+            log.append(f"- Frame url='{fr.url}' title='{fr.name}' -> score={score}")
+    best_score, chosen = ranked[0] if ranked else (_score_frame(page.main_frame), page.main_frame)
+    log.append(f"Frame scelto url='{chosen.url}' score={best_score}")
+    if "curvedicarico" in (chosen.url or "").lower():
+        _FRAME_URL_HINT = urlparse(chosen.url).path
     return chosen
 
 
-async def _try_click_download(frame, log: List[str]) -> bool:
-    for sel in CSV_SELECTORS:
-        try:
-            cnt = await frame.locator(sel).count()
-            log.append(f"download selectors counts: {sel}:{cnt}")
-            if cnt > 0:
-                btn = frame.locator(sel).first
-                with suppress(Exception):
-                    await btn.scroll_into_view_if_needed(timeout=2000)
-                await btn.click(timeout=5000)
-                return True
-        except Exception as e:
-            log.append(f"click selector '{sel}' errore: {type(e).__name__}: {e}")
+async def _try_click_download(frame, log: Deque[str], timeout: int = 10_000) -> bool:
+    # un'unica attesa sul primo candidato visibile (niente attese/count() per singolo
+    # selettore), poi i candidati specifici hanno la precedenza sul pulsante generico
+    try:
+        await frame.locator(CSV_ANY_VISIBLE_SELECTOR).first.wait_for(state="visible", timeout=timeout)
+    except PwTimeoutError:
+        log.append("Nessun pulsante di download CSV visibile.")
+        return False
+    btn = frame.locator(CSV_VISIBLE_SELECTOR).first
+    if await btn.count() == 0:
+        btn = frame.locator(CSV_GENERIC_VISIBLE_SELECTOR).first
+    try:
+        # click() fa già scroll + controlli di actionability
+        await btn.click(timeout=5000)
+        return True
+    except Exception as e:
+        log.append(f"click download errore: {type(e).__name__}: {e}")
     return False
 
 
-async def _do_login_if_needed(page, username: Optional[str], password: Optional[str], log: List[str]) -> bool:
+def _is_csv_response(resp) -> bool:
+    ctype = (resp.headers.get("content-type") or "").lower()
+    if "text/csv" in ctype:
+        return True
+    url = resp.url.lower()
+    return "octet-stream" in ctype and ("download" in url or "export" in url or ".csv" in url)
+
+
+async def _click_and_wait_csv(page, frame, log: Deque[str], timeout: int = 25_000, button_timeout: int = 10_000):
+    """
+    Clicca il pulsante CSV e aspetta il primo tra evento 'download' e una risposta
+    CSV via XHR/fetch (su Lightning capita spesso che non sia un vero download).
+    Restituisce ("download", Download), ("response", Response), ("missing", None)
+    se il pulsante non c'è, (None, None) se scade il timeout.
+    """
+    waiters = {
+        asyncio.ensure_future(page.wait_for_event("download", timeout=timeout)): "download",
+        asyncio.ensure_future(page.wait_for_event("response", predicate=_is_csv_response, timeout=timeout)): "response",
+    }
+    pending = set(waiters)
+    try:
+        # i listener vanno registrati prima del click
+        await asyncio.sleep(0)
+        if not await _try_click_download(frame, log, timeout=button_timeout):
+            return "missing", None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                exc = t.exception()
+                if exc is None:
+                    return waiters[t], t.result()
+                if not isinstance(exc, PwTimeoutError):
+                    raise exc
+        return None, None
+    finally:
+        for t in pending:
+            t.cancel()
+        # raccolgo tutti gli esiti (anche timeout/cancel) per non lasciare eccezioni pendenti
+        await asyncio.gather(*waiters, return_exceptions=True)
+
+
+async def _do_login_if_needed(page, username: Optional[str], password: Optional[str], log: Deque[str]) -> bool:
     if not await _is_login_page(page):
         return True
     if not username or not password:
@@ -95,41 +582,27 @@ async def _do_login_if_needed(page, username: Optional[str], password: Optional[
 
     log.append("Sono in pagina di login. Provo ad autenticarmi…")
 
-    ok = False
-    for s in LOGIN_USER_SELS:
-        with suppress(Exception):
-            if await page.locator(s).count():
-                await page.locator(s).fill(username, timeout=5000)
-                ok = True
-                break
-    if not ok:
+    # un solo locator per campo (union CSS) invece di un count() per selettore
+    try:
+        await page.locator(LOGIN_USER_SELECTOR).first.fill(username, timeout=5000)
+    except Exception:
         log.append("Campo username non trovato in login.")
         return False
 
-    ok = False
-    for s in LOGIN_PASS_SELS:
-        with suppress(Exception):
-            if await page.locator(s).count():
-                await page.locator(s).fill(password, timeout=5000)
-                ok = True
-                break
-    if not ok:
+    try:
+        await page.locator(LOGIN_PASS_SELECTOR).first.fill(password, timeout=5000)
+    except Exception:
         log.append("Campo password non trovato in login.")
         return False
 
-    clicked = False
-    for s in LOGIN_SUBMIT_SELS:
-        with suppress(Exception):
-            if await page.locator(s).count():
-                await page.locator(s).first.click(timeout=5000)
-                clicked = True
-                break
-    if not clicked:
+    try:
+        await page.locator(LOGIN_SUBMIT_SELECTOR).first.click(timeout=5000)
+    except Exception:
         log.append("Bottone di login non trovato.")
         return False
 
     with suppress(PwTimeoutError):
-        await page.wait_for_load_state("domcontentloaded", timeout=15000)
+        await page.wait_for_url(lambda u: "/login" not in u.lower(), timeout=15000)
 
     if await _is_login_page(page):
         log.append("Sembra che la login non sia andata a buon fine (captcha?).")
@@ -139,23 +612,25 @@ async def _do_login_if_needed(page, username: Optional[str], password: Optional[
     return True
 
 
-async def _navigate_with_fallbacks(page, log: List[str]) -> None:
+async def _wait_page_ready(page) -> None:
+    # al posto di networkidle (che su Lightning non arriva quasi mai per via dei
+    # polling XHR) aspetto il primo elemento che ci serve davvero
+    with suppress(PwTimeoutError):
+        await page.locator(READY_SELECTOR).first.wait_for(state="attached", timeout=15_000)
+
+
+async def _navigate_with_fallbacks(page, log: Deque[str]) -> None:
     """
     3 tentativi:
      1) goto(wait_until='domcontentloaded', timeout 120s)
      2) goto(wait_until='load',            timeout 120s)
      3) goto senza wait_until + attesa selettori noti
     """
-    page.set_default_timeout(60_000)
-    page.context.set_default_timeout(60_000)
-    page.set_default_navigation_timeout(60_000)
-
     # 1 – domcontentloaded
     try:
         log.append("NAV attempt #1: domcontentloaded (120s)")
         await page.goto(CURVE_URL, wait_until="domcontentloaded", timeout=120_000)
-        with suppress(PwTimeoutError):
-            await page.wait_for_load_state("networkidle", timeout=3_000)
+        await _wait_page_ready(page)
         return
     except Exception as e:
         log.append(f"Attempt #1 fallito: {type(e).__name__}: {e}")
@@ -164,8 +639,7 @@ async def _navigate_with_fallbacks(page, log: List[str]) -> None:
     try:
         log.append("NAV attempt #2: load (120s)")
         await page.goto(CURVE_URL, wait_until="load", timeout=120_000)
-        with suppress(PwTimeoutError):
-            await page.wait_for_load_state("networkidle", timeout=3_000)
+        await _wait_page_ready(page)
         return
     except Exception as e:
         log.append(f"Attempt #2 fallito: {type(e).__name__}: {e}")
@@ -173,13 +647,12 @@ async def _navigate_with_fallbacks(page, log: List[str]) -> None:
     # 3 – senza wait_until + attesa euristica
     log.append("NAV attempt #3: no wait_until + attesa euristica (15s)")
     await page.goto(CURVE_URL, timeout=120_000)
-    # attendo che l’URL contenga la route corretta o la login
-    for _ in range(15):
-        u = (page.url or "").lower()
-        if "curvedicarico" in u or "/login" in u:
-            break
-        with suppress(PwTimeoutError):
-            await page.wait_for_timeout(1000)
+    # attendo (a eventi, non a polling) che l’URL contenga la route corretta o la login
+    with suppress(PwTimeoutError):
+        await page.wait_for_url(
+            lambda u: "curvedicarico" in u.lower() or "/login" in u.lower(),
+            timeout=15_000,
+        )
     # in ogni caso ritorno al chiamante; eventuali login/frames vengono gestiti dopo
 
 
@@ -191,134 +664,208 @@ async def refresh_and_download_csv_async(
     username: Optional[str] = None,
     password: Optional[str] = None,
 ) -> Dict[str, Any]:
-    log: List[str] = []
+    # buffer limitato: in caso di retry/errori a raffica non cresce senza fine
+    log: Deque[str] = deque(maxlen=LOG_MAX_LINES)
     log.append(f"edis_pw version: {VERSION}")
-    sending = {
-        "pod": pod,
-        "date_from": date_from,
-        "date_to": date_to,
-        "use_storage": use_storage,
-        "username": username,
-        "password": "***" if password else None,
-    }
-    log.append(f"sending={json.dumps(sending)}")
+    if DEBUG:
+        sending = {
+            "pod": pod,
+            "date_from": date_from,
+            "date_to": date_to,
+            "use_storage": use_storage,
+            "username": username,
+            "password": "***" if password else None,
+        }
+        log.append(f"sending={sending!r}")
     log.append("=== refresh_and_download_csv: start ===")
 
     storage_path = _storage_state_path() if use_storage else None
     if use_storage and not storage_path:
         log.append("ATTENZIONE: use_storage=True ma storage_state non trovato/valido.")
 
+    # sessione salvata già scaduta: si risponde subito, senza toccare browser,
+    # context o download diretto (che fallirebbero comunque)
+    expired = False
+    if storage_path:
+        with suppress(OSError, ValueError):
+            expired = _session_expired(storage_path)
+    if expired:
+        return {
+            "ok": False,
+            "detail": "Sessione salvata non valida/scaduta. Disattiva 'Usa sessione salvata' oppure rigenera lo storage_state.",
+            "log": list(log),
+        }
+
+    context = None
+    page = None
+    stale = False
+    storage_mtime = _storage_state_mtime(storage_path) if storage_path else None
+    cred = _cred_digest(password)
+    ctx_key = (storage_path, storage_mtime, username, cred)
+    warm_key = (storage_path, username, cred)
+    park = False
+    dl_key = (storage_path, username, cred, pod, date_from, date_to)
     try:
-        async with async_playwright() as pw:
-            browser = await pw.chromium.launch(
-                headless=True,
-                args=[
-                    "--no-sandbox",
-                    "--disable-dev-shm-usage",
-                    "--disable-features=site-per-process",
-                ],
-            )
-
-            context_args: Dict[str, Any] = {
-                "accept_downloads": True,
-                "java_script_enabled": True,
-                # User-Agent reale di Chrome stabile
-                "user_agent": (
-                    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                    "AppleWebKit/537.36 (KHTML, like Gecko) "
-                    "Chrome/124.0.0.0 Safari/537.36"
-                ),
-            }
-            if storage_path:
-                context_args["storage_state"] = storage_path
+        browser = await _get_browser()
+
+        context = await _get_context(browser, ctx_key, storage_path)
+
+        # scorciatoia: stesso download già visto -> una sola GET, niente DOM
+        cached_url = _DOWNLOAD_URLS.get(dl_key)
+        if cached_url:
+            _DOWNLOAD_URLS.move_to_end(dl_key)
+            if await _try_direct_download(context, cached_url, log):
+                if storage_path:
+                    with suppress(Exception):
+                        await _persist_storage_state(context, storage_path, ctx_key, log)
+                return {"ok": True, "detail": "Download ottenuto (HTTP diretto).", "log": list(log)}
+            _DOWNLOAD_URLS.pop(dl_key, None)
+
+        # pagina parcheggiata da un job precedente, già su curvedicarico:
+        # salto navigazione e login e clicco subito. Ripiego su una pagina nuova
+        # solo se il click non è partito: altrimenti l'export partirebbe due volte
+        page = await _take_warm_page(warm_key, context)
+        kind, obj = None, None
+        if page is not None:
+            log.append("Riuso la pagina già aperta su curvedicarico.")
+            frame = _pick_main_frame(page, log)
+            try:
+                kind, obj = await _click_and_wait_csv(
+                    page, frame, log, timeout=WARM_CSV_TIMEOUT_MS, button_timeout=WARM_BUTTON_TIMEOUT_MS
+                )
+            except Exception as e:
+                log.append(f"Pagina riusata non valida: {type(e).__name__}: {e}")
+                kind = "missing"
+            if kind == "missing":
+                log.append("Ripiego su una nuova pagina.")
+                with suppress(Exception):
+                    await page.close()
+                page, kind, obj = None, None, None
 
-            context = await browser.new_context(**context_args)
+        if page is None:
             page = await context.new_page()
+            await _block_assets(page)
 
             # navigazione con fallbacks
             try:
                 await _navigate_with_fallbacks(page, log)
             except Exception as e:
-                await context.close(); await browser.close()
                 return {
                     "ok": False,
                     "detail": f"Goto error: {type(e).__name__}: {e}",
-                    "log": log,
+                    "log": list(log),
                 }
 
             # se sessione salvata ma ci porta alla login -> storage scaduto
             if use_storage and await _is_login_page(page):
-                await context.close(); await browser.close()
+                stale = True
                 return {
                     "ok": False,
                     "detail": "Sessione salvata non valida/scaduta. Disattiva 'Usa sessione salvata' oppure rigenera lo storage_state.",
-                    "log": log,
+                    "log": list(log),
                 }
 
             # senza storage: se serve, prova login
             if not use_storage:
                 ok = await _do_login_if_needed(page, username, password, log)
                 if not ok:
-                    await context.close(); await browser.close()
+                    stale = True
                     return {
                         "ok": False,
                         "detail": "Impossibile autenticarsi (mancano campi o captcha).",
-                        "log": log,
+                        "log": list(log),
                     }
                 with suppress(Exception):
                     await _navigate_with_fallbacks(page, log)
 
             # trova frame e click
-            frame = await _pick_main_frame(page, log)
+            frame = _pick_main_frame(page, log)
             log.append("Provo click 'Download CSV' e aspetto il download…")
 
-            downloaded = False
             try:
-                async with page.expect_download(timeout=25_000) as dl_info:
-                    clicked = await _try_click_download(frame, log)
-                    if not clicked:
-                        await context.close(); await browser.close()
-                        return {
-                            "ok": False,
-                            "detail": "Pulsante download CSV non trovato (verifica selettori).",
-                            "log": log,
-                        }
-                download = await dl_info.value
-                with suppress(Exception):
-                    tmp = await download.path()
-                    log.append(f"Download file: {download.suggested_filename}, path={tmp}")
-                downloaded = True
-            except PwTimeoutError:
-                # a volte è XHR, non un vero "download"
-                if await frame.locator("|".join(CSV_SELECTORS)).count() > 0:
-                    log.append("Click eseguito, ma non ho intercettato un evento 'download' (probabile XHR).")
-                    downloaded = True
-                else:
-                    downloaded = False
+                kind, obj = await _click_and_wait_csv(page, frame, log)
             except Exception as e:
-                await context.close(); await browser.close()
                 return {
                     "ok": False,
                     "detail": f"Errore durante il tentativo di download: {type(e).__name__}: {e}",
-                    "log": log,
+                    "log": list(log),
                 }
 
-            await context.close()
-            await browser.close()
+        if kind == "missing":
+            return {
+                "ok": False,
+                "detail": "Pulsante download CSV non trovato (verifica selettori).",
+                "log": list(log),
+            }
 
-            if downloaded:
-                return {"ok": True, "detail": "Download avviato/ottenuto.", "log": log}
-            else:
-                return {
-                    "ok": False,
-                    "detail": "Non sono riuscito ad avviare/ottenere il download del CSV.",
-                    "log": log,
-                }
+        if kind == "download":
+            download = obj
+            if download.url.startswith("http"):
+                _remember_download_url(dl_key, download.url)
+            with suppress(Exception):
+                tmp = await download.path()
+                log.append(f"Download file: {download.suggested_filename}, path={tmp}")
+            downloaded = True
+        elif kind == "response":
+            log.append(f"CSV ricevuto via XHR: {obj.url}")
+            if obj.request.method == "GET" and obj.url.startswith("http"):
+                _remember_download_url(dl_key, obj.url)
+            downloaded = True
+        # né download né risposta CSV entro il timeout
+        elif await frame.locator(CSV_SELECTOR).count() > 0:
+            log.append("Click eseguito, ma non ho intercettato un evento 'download' (probabile XHR).")
+            downloaded = True
+        else:
+            downloaded = False
+
+        if downloaded:
+            park = kind in ("download", "response")
+            if storage_path:
+                with suppress(Exception):
+                    await _persist_storage_state(context, storage_path, ctx_key, log)
+            return {"ok": True, "detail": "Download avviato/ottenuto.", "log": list(log)}
+        else:
+            return {
+                "ok": False,
+                "detail": "Non sono riuscito ad avviare/ottenere il download del CSV.",
+                "log": list(log),
+            }
 
     except Exception as e:
+        stale = True
         # messaggio raw, senza la dicitura "waiting until networkidle"
         return {
             "ok": False,
             "detail": f"{type(e).__name__}: {e}",
-            "log": log,
+            "log": list(log),
         }
+    finally:
+        # browser e context restano vivi: la pagina del job viene parcheggiata
+        # se il download è andato, altrimenti chiusa; il context viene scartato
+        # solo se la sessione non è più buona, e chiuso dall'ultimo job che lo usa
+        if page is not None:
+            if park:
+                await _park_page(warm_key, page)
+            else:
+                with suppress(Exception):
+                    await page.close()
+        if context is not None:
+            if stale:
+                _drop_context(context)
+            await _release_context(context)
+
+
+async def refresh_many(jobs: List[Dict[str, Any]], concurrency: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Esegue più refresh (es. più POD) in parallelo sullo stesso browser condiviso,
+    con al massimo `concurrency` job attivi insieme (default PW_MAX_CONTEXTS).
+    Ogni job è un dict con gli argomenti di refresh_and_download_csv_async;
+    i risultati sono nello stesso ordine dei job.
+    """
+    sem = asyncio.Semaphore(max(1, concurrency or PW_MAX_CONTEXTS))
+
+    async def _one(job: Dict[str, Any]) -> Dict[str, Any]:
+        async with sem:
+            return await refresh_and_download_csv_async(**job)
+
+    return list(await asyncio.gather(*(_one(j) for j in jobs)))
@@ -1,13 +1,16 @@
 # main.py
 import os
 import json
+import asyncio
+from contextlib import suppress
 from typing import Optional, List, Dict, Any
 
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 
-from edis_pw import refresh_and_download_csv_async, VERSION  # <-- niente SessionMissingError
+from edis_pw import refresh_and_download_csv_async, start_browser, close_browser, VERSION  # <-- niente SessionMissingError
 
 # -------- util --------
 
@@ -33,12 +36,18 @@ def _get_allowed_origins() -> List[str]:
 
 ALLOW_ORIGINS = _get_allowed_origins()
 
+# /refresh concorrenti (ognuno tiene una pagina Chromium aperta): oltre il limite
+# si aspetta in coda, e dopo REFRESH_QUEUE_TIMEOUT secondi si risponde 503
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "3"))
+REFRESH_QUEUE_TIMEOUT = float(os.getenv("REFRESH_QUEUE_TIMEOUT", "60"))
+_REFRESH_SEM = asyncio.Semaphore(MAX_CONCURRENCY)
+
 def _storage_state_path() -> str:
     return os.getenv("STORAGE_STATE", "/app/storage_state.json")
 
 # -------- app --------
 
-app = FastAPI(title="edis-middleware")
+app = FastAPI(title="edis-middleware", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -48,6 +57,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+@app.on_event("startup")
+async def _startup():
+    # se Chromium non parte qui, ci riprova la prima /refresh
+    with suppress(Exception):
+        await start_browser()
+
+
+@app.on_event("shutdown")
+async def _shutdown():
+    await close_browser()
+
+
 class RefreshPayload(BaseModel):
     pod: str
     date_from: str
@@ -65,8 +87,13 @@ async def healthz():
 @app.get("/diag")
 async def diag():
     path = _storage_state_path()
-    exists = os.path.exists(path)
-    size = os.path.getsize(path) if exists else 0
+    # un solo stat: il file non viene letto né parsato
+    try:
+        size = os.stat(path).st_size
+        exists = True
+    except OSError:
+        size = 0
+        exists = False
     return {
         "version": "diag-1",
         "storage_state_path": path,
@@ -78,12 +105,14 @@ async def diag():
 
 @app.post("/refresh")
 async def refresh(payload: RefreshPayload, request: Request):
-    # non logghiamo la password in chiaro
-    sending: Dict[str, Any] = payload.dict()
-    if sending.get("password"):
-        sending["password"] = "***"
-
-    log: List[str] = [f"sending={json.dumps(sending)}"]
+    try:
+        await asyncio.wait_for(_REFRESH_SEM.acquire(), timeout=REFRESH_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return ORJSONResponse(
+            status_code=503,
+            headers={"Retry-After": str(int(REFRESH_QUEUE_TIMEOUT))},
+            content={"ok": False, "detail": "Troppe richieste in corso, riprova più tardi.", "log": []},
+        )
 
     try:
         res = await refresh_and_download_csv_async(
@@ -95,14 +124,20 @@ async def refresh(payload: RefreshPayload, request: Request):
             password=payload.password,
         )
         # includo il log lato server per facilitarne la lettura dal front-end
-        if "log" in res:
-            res["log"] = res["log"]
-        else:
-            res["log"] = log
+        res.setdefault("log", [])
         return res
     except Exception as e:
-        log.append(f"server exception: {type(e).__name__}: {e}")
+        # il payload finisce nel log solo in caso di errore (password mascherata)
+        sending: Dict[str, Any] = payload.dict()
+        if sending.get("password"):
+            sending["password"] = "***"
+        log: List[str] = [
+            f"sending={json.dumps(sending)}",
+            f"server exception: {type(e).__name__}: {e}",
+        ]
         return {"ok": False, "detail": str(e), "log": log}
+    finally:
+        _REFRESH_SEM.release()
 
 
 if __name__ == "__main__":